@@ -7,6 +7,7 @@ import logging
 import uvicorn
 
 from src.database import create_db_and_tables
+from src.heartbeats import HeartbeatBuffer
 from src.routes import router
 from src.processors.manager import ProcessorManager
 
@@ -17,35 +18,43 @@ logger = logging.getLogger(__name__)
 # Initialize processors
 manager = ProcessorManager()
 processors_path = os.path.join(os.path.dirname(__file__), "src", "processors")
-manager.load_all(processors_path, router)
-
-# Create database and tables (this should be done before starting the app, but after defining models)
-create_db_and_tables()
+manager.load_all(processors_path)
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    # Create database and tables (after the processors defined their models) without blocking the event loop
+    await asyncio.to_thread(create_db_and_tables)
 
-
-    # Start interval loop
+    # Start interval loop and the heartbeat writer
     task = asyncio.create_task(manager.start_interval_loop())
+    heartbeat_buffer = HeartbeatBuffer()
+    heartbeat_task = asyncio.create_task(heartbeat_buffer.run_flush_loop())
 
     yield
 
-    # Clean up
-    manager.shutdown()
-    task.cancel()
+    # Clean up, the interval loops exit right away instead of finishing their sleep
+    manager.stop()
+    heartbeat_buffer.stop()
     try:
         await task
     except asyncio.CancelledError:
         pass
+    # Writes the heartbeats received since the last flush
+    await heartbeat_task
+    await asyncio.to_thread(manager.shutdown)
 
 app = FastAPI(title="Clogs Server", version="0.1.0", lifespan=lifespan)
 app.include_router(router)
+for processor_router in manager.routers:
+    app.include_router(processor_router)
 
 @app.get("/")
-async def root():
+async def root() -> dict[str, str]:
     return {"message": "Clogs Server is running"}
 
 if __name__ == "__main__":
     # Run the server with: uvicorn main:app --host 0.0.0.0 --port 8000
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Keep a single worker: the processor interval loops, the heartbeat buffer and the caches live in this process, a
+    # second worker would run the processors twice and miss the other's cache invalidations. "auto" picks uvloop and
+    # httptools, which uvicorn[standard] installs, and falls back to asyncio and h11 without them.
+    uvicorn.run(app, host="0.0.0.0", port=8000, workers=1, loop="auto", http="auto")
@@ -0,0 +1,88 @@
+from functools import wraps
+from time import monotonic
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """
+    In-process set of keys that are forgotten after a fixed time, used to skip repeated existence lookups.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: Seconds a key is remembered after it was added
+        """
+        self.ttl = ttl
+        self._expires_at: dict[Hashable, float] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires_at = self._expires_at.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < monotonic():
+            self._expires_at.pop(key, None)
+            return False
+        return True
+
+    def add(self, key: Hashable):
+        self._expires_at[key] = monotonic() + self.ttl
+
+    def discard(self, key: Hashable):
+        self._expires_at.pop(key, None)
+
+    def clear(self):
+        self._expires_at.clear()
+
+
+class ResponseCache:
+    """
+    In-process cache of endpoint results, dropped after a fixed time or as soon as a write clears it.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: Seconds a result is served from the cache
+        """
+        self.ttl = ttl
+        self._entries: dict[Hashable, tuple[float, Any]] = {}
+        # Bumped by clear, results computed across a clear are not stored since they may predate the write
+        self._generation = 0
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        :param key: The key of the result
+        :param compute: Computes the result if it is not cached or has expired
+        :return: The cached or computed result
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= monotonic():
+            return entry[1]
+
+        generation = self._generation
+        value = compute()
+        if generation == self._generation:
+            self._entries[key] = (monotonic() + self.ttl, value)
+        return value
+
+    def cached(self, key: Hashable) -> Callable:
+        """
+        Decorates an endpoint without parameters (other than dependencies) to serve its result from the cache.
+        :param key: The key of the endpoint's result
+        """
+        def decorator(endpoint: Callable) -> Callable:
+            @wraps(endpoint)
+            def wrapper(*args, **kwargs):
+                return self.get_or_compute(key, lambda: endpoint(*args, **kwargs))
+            return wrapper
+        return decorator
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+
+# Agent ids that are known to exist
+known_agents = TTLCache(ttl=60)
+# Snapshots of the web API, polled by the dashboard. They may lag behind by up to the TTL for changes that do not go
+# through the agent endpoints (heartbeats, processor intervals), the agent endpoints clear them on every write.
+web_responses = ResponseCache(ttl=5)
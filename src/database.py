@@ -1,6 +1,10 @@
 from typing import Annotated, Type, Any, Optional
 
 from fastapi import Depends
+from sqlalchemy import MetaData, Table, event, inspect, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.schema import CreateTable
 from sqlmodel import Session, SQLModel, create_engine
 import logging
 import os
@@ -14,14 +18,76 @@ os.makedirs(os.path.dirname(sqlite_file_name), exist_ok=True)
 
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+# The sqlite3 driver timeout (seconds) matches the busy_timeout pragma below (milliseconds)
+connect_args = {"check_same_thread": False, "timeout": 5.0}
+
+# Connections kept open by the pool, the processor intervals are capped so they can never take all of them
+POOL_SIZE = 20
+
+if ":memory:" in sqlite_url:
+    # Every connection to an in-memory database would open a separate, empty database, so they all share one
+    engine = create_engine(sqlite_url, connect_args=connect_args, poolclass=StaticPool)
+else:
+    # Keep connections (and their WAL / mmap state) open between sessions instead of reopening the file per checkout.
+    # A local SQLite file cannot drop connections, so there is nothing for pre-ping to detect, recycling is only a
+    # safeguard. The overflow absorbs request bursts on top of the steady pool.
+    engine = create_engine(
+        sqlite_url,
+        connect_args=connect_args,
+        poolclass=QueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=40,
+        pool_pre_ping=False,
+        pool_recycle=3600,
+    )
+
+# WAL lets readers proceed while the processors commit, synchronous=NORMAL is durable enough in WAL mode.
+# SQLite only enforces foreign keys (and runs their ON DELETE actions) when enabled per connection.
+sqlite_pragmas = (
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+if sqlite_url.startswith("sqlite:") and ":memory:" not in sqlite_url:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+# Short-lived sessions for the processors, one per unit of work instead of one pinned per processor
+SessionLocal = sessionmaker(bind=engine, class_=Session, expire_on_commit=False)
+
+_processor_manager = None
+
+
+def _get_processor_manager():
+    global _processor_manager
+    if _processor_manager is None:
+        # Import locally to avoid circular dependency
+        from src.processors.manager import ProcessorManager
+        _processor_manager = ProcessorManager()
+    return _processor_manager
 
 
 class ProcessorSession(Session):
     def add(self, instance: Any, _warn: bool = True) -> None:
+        super().add(self.prepare_insert(instance), _warn=_warn)
+
+    def prepare_insert(self, instance: Any) -> Any:
+        """
+        Runs the on_insert processor hooks for an instance, for inserts that do not go through add (e.g. bulk inserts).
+        :param instance: The instance about to be inserted
+        :return: The instance to insert in its place
+        """
         pp = self._run_processor_hook("on_insert", instance)
-        super().add(instance if not pp else pp, _warn=_warn)
+        return instance if not pp else pp
 
     def delete(self, instance: Any) -> None:
         pp = self._run_processor_hook("on_delete", instance)
@@ -37,20 +103,13 @@ class ProcessorSession(Session):
     @staticmethod
     def _run_processor_hook(method_name: str, instance: Any, model_type: Type = None) -> Any:
         try:
-            # Import locally to avoid circular dependency
-            from src.processors.manager import ProcessorManager
-
             if model_type is None:
                 model_type = type(instance)
 
-            processors = ProcessorManager().get_processors(model_type)
-            for processor in processors:
-                method = getattr(processor, method_name)
+            for method, output_type in _get_processor_manager().get_hooks(model_type, method_name):
                 try:
                     post_instance = method(instance)
 
-                    output_type = ProcessorManager().get_output_type(type(processor))
-
                     if output_type is None and post_instance is None:
                         return instance
                     elif post_instance is not None and output_type is None:
@@ -70,9 +129,95 @@ class ProcessorSession(Session):
             logger.error(f"Error running processor hook: {e}")
 
 
+def _has_outdated_foreign_keys(connection, table: Table) -> bool:
+    """
+    Checks if the ON DELETE actions of a table's foreign keys in the database differ from the declared ones.
+    """
+    declared = {fk.parent.name: (fk.ondelete or "NO ACTION").upper() for fk in table.foreign_keys}
+    return any(
+        declared.get(foreign_key["from"], "NO ACTION") != foreign_key["on_delete"].upper()
+        for foreign_key in connection.exec_driver_sql(f'PRAGMA foreign_key_list("{table.name}")').mappings()
+    )
+
+
+def _rebuild_tables(tables: list[Table]):
+    """
+    Recreates tables with their declared definition, for changes ALTER TABLE cannot make (e.g. foreign key actions).
+    Follows SQLite's procedure: create the new table, copy the rows, drop the old table and rename the new one.
+    The indexes are dropped along with the old tables, create_db_and_tables creates them again.
+    :param tables: The tables to rebuild, all columns must exist already
+    """
+    # The new tables are built from copies, so their foreign keys resolve without adding tables to the models' metadata
+    metadata = MetaData()
+    for table in SQLModel.metadata.sorted_tables:
+        table.to_metadata(metadata)
+
+    with engine.connect() as connection:
+        # The other tables keep referencing the tables while they are swapped. The pragma has no effect inside a
+        # transaction, so it is set before the transaction begins.
+        connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        connection.exec_driver_sql("BEGIN")
+        try:
+            for table in tables:
+                logger.info(f"Rebuilding table {table.name} to update its foreign keys")
+                new_table = table.to_metadata(metadata, name=f"_new_{table.name}")
+                connection.execute(CreateTable(new_table))
+
+                # Copied in rowid order, so the rows keep their insertion order
+                columns = ", ".join(f'"{column.name}"' for column in table.columns)
+                connection.exec_driver_sql(
+                    f'INSERT INTO "{new_table.name}" ({columns}) SELECT {columns} FROM "{table.name}" ORDER BY rowid'
+                )
+                connection.exec_driver_sql(f'DROP TABLE "{table.name}"')
+                connection.exec_driver_sql(f'ALTER TABLE "{new_table.name}" RENAME TO "{table.name}"')
+
+            # Rows left behind by deletes from before the foreign keys were enforced, they are kept as they are
+            orphans = connection.exec_driver_sql("PRAGMA foreign_key_check").all()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+    if orphans:
+        logger.warning(f"{len(orphans)} rows reference rows that no longer exist")
+
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
+    # create_all skips tables that already exist, so add columns introduced later on separately
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        outdated: list[Table] = []
+        for table in SQLModel.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    logger.info(f"Adding column {column.name} to table {table.name}")
+                    column_type = column.type.compile(dialect=connection.dialect)
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+
+            # SQLite cannot change the constraints of an existing table, tables created before their ON DELETE actions
+            # were declared would keep rejecting deletes of rows that are still referenced
+            if _has_outdated_foreign_keys(connection, table):
+                outdated.append(table)
+
+    if outdated:
+        _rebuild_tables(outdated)
+
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+        # journal_mode=WAL does not fail where WAL is unsupported (e.g. network file systems), SQLite silently keeps
+        # the rollback journal, where writers block the readers
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        if str(journal_mode).lower() != "wal" and ":memory:" not in sqlite_url:
+            logger.warning(f"SQLite is using journal mode {journal_mode} instead of WAL, reads will wait for writes")
+
 
 def get_session():
     with ProcessorSession(engine) as session:
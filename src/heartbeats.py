@@ -0,0 +1,123 @@
+import asyncio
+import logging
+
+from sqlalchemy import bindparam, delete, exists, insert, select, update
+
+from src.database import SessionLocal
+from src.models.agents import Agent, Heartbeat
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two writes of the buffered heartbeats
+FLUSH_INTERVAL = 0.5
+# Most heartbeats written in one transaction, larger backlogs are written in several
+MAX_FLUSH_BATCH = 1000
+# Nanoseconds heartbeats are kept for, the newest one of each agent is also kept on the agent row
+HEARTBEAT_RETENTION_NS = 24 * 60 * 60 * 1_000_000_000
+
+# Executed with one {"agent_id", "timestamp"} row per heartbeat. Heartbeats of agents that were deleted after the
+# heartbeat was received are dropped instead of failing the whole batch.
+_insert_heartbeats = insert(Heartbeat.__table__).from_select(
+    ["agent_id", "timestamp"],
+    select(bindparam("agent_id"), bindparam("timestamp")).where(exists().where(Agent.id == bindparam("agent_id"))),
+)
+_update_last_heartbeat = update(Agent.__table__).where(
+    Agent.__table__.c.id == bindparam("agent_id")
+).values(
+    last_heartbeat_ns=bindparam("timestamp"),
+    # Heartbeats are not configuration changes, keep updated_at (the ETag of the agent's config) from firing onupdate
+    updated_at=Agent.__table__.c.updated_at,
+)
+# Executed with one {"agent_id", "before"} row per agent of the flush, seeks the agent's old heartbeats in its index
+_prune_heartbeats = delete(Heartbeat.__table__).where(
+    Heartbeat.__table__.c.agent_id == bindparam("agent_id"),
+    Heartbeat.__table__.c.timestamp < bindparam("before"),
+)
+
+
+class HeartbeatBuffer:
+    """
+    Collects received heartbeats in a queue and writes them in bulk, so the heartbeat endpoint does not commit per request.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.queue = None
+            cls._instance.stop_event = None
+        return cls._instance
+
+    def append(self, agent_id: str, timestamp: int):
+        """
+        Queues a heartbeat for the next flush. Must be called from the event loop, after run_flush_loop started.
+        """
+        self.queue.put_nowait((agent_id, timestamp))
+
+    @staticmethod
+    def flush(batch: list[tuple[str, int]]) -> int:
+        """
+        Writes heartbeats and the newest heartbeat of each agent in one transaction, and drops the heartbeats of these
+        agents that are older than HEARTBEAT_RETENTION_NS.
+        :param batch: The (agent_id, timestamp) pairs to write
+        :return: The number of heartbeats written
+        """
+        if not batch:
+            return 0
+
+        latest: dict[str, int] = {}
+        for agent_id, timestamp in batch:
+            if timestamp > latest.get(agent_id, 0):
+                latest[agent_id] = timestamp
+
+        with SessionLocal() as session:
+            session.exec(_insert_heartbeats, params=[
+                {"agent_id": agent_id, "timestamp": timestamp} for agent_id, timestamp in batch
+            ])
+            session.exec(_update_last_heartbeat, params=[
+                {"agent_id": agent_id, "timestamp": timestamp} for agent_id, timestamp in latest.items()
+            ])
+            session.exec(_prune_heartbeats, params=[
+                {"agent_id": agent_id, "before": timestamp - HEARTBEAT_RETENTION_NS}
+                for agent_id, timestamp in latest.items()
+            ])
+            session.commit()
+
+        return len(batch)
+
+    async def _flush_queued(self):
+        while not self.queue.empty():
+            batch: list[tuple[str, int]] = []
+            while len(batch) < MAX_FLUSH_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                await asyncio.to_thread(self.flush, batch)
+            except Exception as e:
+                logger.error(f"Error flushing heartbeats: {e}")
+                # Keep the heartbeats for the next flush
+                for item in batch:
+                    self.queue.put_nowait(item)
+                return
+
+    async def run_flush_loop(self):
+        """
+        Flushes the queue every FLUSH_INTERVAL seconds until stop() is called, and once more after that.
+        """
+        # Created here so the queue belongs to the running event loop
+        self.queue = asyncio.Queue()
+        self.stop_event = asyncio.Event()
+        while not self.stop_event.is_set():
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=FLUSH_INTERVAL)
+            except TimeoutError:
+                pass
+
+            await self._flush_queued()
+
+    def stop(self):
+        """
+        Signals the flush loop to write the remaining heartbeats and exit. Must be called from the event loop.
+        """
+        if self.stop_event is not None:
+            self.stop_event.set()
@@ -1,14 +1,19 @@
 from enum import Enum
-from typing import Protocol, runtime_checkable
-from uuid import uuid4
+from secrets import token_hex
+from time import time_ns
+from typing import Iterator, Protocol, runtime_checkable
 
-from sqlmodel import SQLModel, Field
+from sqlalchemy import Index, bindparam, exists, insert
+from sqlmodel import SQLModel, Field, select
 from pydantic import BaseModel
 
-from src.database import SessionDep
+from src.database import ProcessorSession, SessionDep
 
 
-class Agent(SQLModel, table=True):
+class AgentConfig(SQLModel):
+    """
+    The configuration of an agent, served to the agent without the columns the server maintains.
+    """
     id: str | None = Field(default=None, primary_key=True)
     hostname: str | None = Field(nullable=True)
     heartbeat_interval: int = Field(default=30, nullable=False)
@@ -16,9 +21,19 @@ class Agent(SQLModel, table=True):
     on_host: bool = Field(nullable=False)
 
 
+class Agent(AgentConfig, table=True):
+    # Timestamp (ns) of the newest heartbeat, kept here so the heartbeat check does not need to search the heartbeats
+    last_heartbeat_ns: int | None = Field(default=None)
+    # Timestamp (ns) of the last write to the row, used as the ETag of the agent's GET endpoints
+    updated_at: int | None = Field(default_factory=time_ns, sa_column_kwargs={"onupdate": time_ns})
+
+
 class Heartbeat(SQLModel, table=True):
+    # Heartbeats are only kept as a history, the index serves the pruning of each agent's old heartbeats on flush
+    __table_args__ = (Index("ix_heartbeat_agent_id_timestamp", "agent_id", "timestamp"),)
+
     id: int | None = Field(default=None, primary_key=True)
-    agent_id: str = Field(foreign_key="agent.id", index=True, nullable=False)
+    agent_id: str = Field(foreign_key="agent.id", ondelete="CASCADE", nullable=False)
     timestamp: int = Field(nullable=False)
 
 
@@ -30,9 +45,10 @@ class ContextType(str, Enum):
 
 class Context(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    agent_id: str | None = Field(default=None, nullable=False, foreign_key="agent.id", index=True)
+    agent_id: str | None = Field(default=None, nullable=False, foreign_key="agent.id", ondelete="CASCADE", index=True)
     name: str = Field(nullable=False)
     type: ContextType = Field(nullable=False)
+    updated_at: int | None = Field(default_factory=time_ns, sa_column_kwargs={"onupdate": time_ns})
 
 
 ### Container Models ###
@@ -42,15 +58,16 @@ class Container(SQLModel, table=True):
     Represents a container being monitored by an agent.
     """
     id: str | None = Field(default=None, primary_key=True)
-    agent_id: str = Field(nullable=False, foreign_key="agent.id", index=True)
-    context: int | None = Field(default=None, foreign_key="context.id", index=True)
+    agent_id: str = Field(nullable=False, foreign_key="agent.id", ondelete="CASCADE", index=True)
+    context: int | None = Field(default=None, foreign_key="context.id", ondelete="SET NULL", index=True)
     name: str = Field(nullable=False)
     image: str = Field(nullable=False)
     created_at: int = Field(nullable=False)
+    updated_at: int | None = Field(default_factory=time_ns, sa_column_kwargs={"onupdate": time_ns})
 
 
 class ContainerState(SQLModel, table=True):
-    id: str | None = Field(default=None, primary_key=True, foreign_key="container.id")
+    id: str | None = Field(default=None, primary_key=True, foreign_key="container.id", ondelete="CASCADE")
     status: str = Field(nullable=False)
     since: int = Field(nullable=False)
 
@@ -63,30 +80,156 @@ class LogProtocol(Protocol):
         ...
 
 
-class Log(SQLModel, table=True):
+def new_log_id() -> str:
     """
-    Represents a single log entry from a container.
+    Generates a log ID that sorts by creation time, so new log rows are appended at the end of the primary key index
+    instead of being scattered across it like random UUIDs.
+    """
+    return f"{time_ns():016x}{token_hex(8)}"
+
+
+def new_log_ids(count: int) -> Iterator[str]:
+    """
+    Generates the log IDs of a batch, like new_log_id but with a single clock read and random draw for the whole batch.
+    The timestamps are offset by the position in the batch, so the IDs keep the order of the entries.
+    :param count: The number of IDs to generate
+    """
+    timestamp = time_ns()
+    random = token_hex(8 * count)
+    for i in range(count):
+        yield f"{timestamp + i:016x}{random[i * 16:(i + 1) * 16]}"
+
+
+def new_id() -> str:
+    """
+    Generates a random 128-bit ID as hex, without building a UUID object just to format it.
+    """
+    return token_hex(16)
+
+
+class LogEntry(SQLModel):
+    """
+    The fields of a log entry, used to receive log transfers. Validating plain models is several times faster than
+    validating the table model, which pays for the SQLAlchemy instrumentation on every entry.
     """
     id: str | None = Field(default=None, primary_key=True)
-    container_id: str = Field(nullable=False, foreign_key="container.id", index=True)
+    container_id: str = Field(nullable=False, foreign_key="container.id", ondelete="CASCADE")
     timestamp: int = Field(nullable=False)
     level: str = Field(nullable=False)
     message: str = Field(nullable=False)
 
+    def to_log(self, log_id: str | None = None) -> "Log":
+        """
+        Builds the table model of this entry without validating it again.
+        :param log_id: The ID to use if the entry has none, a new one is generated if not given either
+        :return: The log entry, ready to be inserted
+        """
+        return Log.model_construct(**{**self.__dict__, "id": self.id or log_id or new_log_id()})
+
     def add_log_entries(self, session: SessionDep, agent_id: str | None, container_id: str | None):
         """
         Adds this log entry to the database session for the specified agent and container.
         :param session: Database session
-        :param agent_id: Not used in this context, kept for protocol compatibility
-        :param container_id: Not used in this context, kept for protocol compatibility
+        :param agent_id: The ID of the agent uploading the log, the container must belong to it
+        :param container_id: Container ID from the request, must match self.container_id if given
+        """
+        self.to_log().add_log_entries(session, agent_id, container_id)
+
+
+class Log(LogEntry, table=True):
+    """
+    Represents a single log entry from a container.
+    """
+    # Serve the per-container lookups and the newest logs of a container, optionally of one level, without sorting.
+    # SQLite walks the indexes backwards for descending order, so they need no DESC columns.
+    __table_args__ = (
+        Index("ix_log_container_id_timestamp", "container_id", "timestamp"),
+        Index("ix_log_container_id_level_timestamp", "container_id", "level", "timestamp"),
+    )
+
+    def to_log(self, log_id: str | None = None) -> "Log":
+        # Already the table model, only make sure it has an ID
+        if self.id is None:
+            self.id = log_id or new_log_id()
+        return self
+
+    def add_log_entries(self, session: SessionDep, agent_id: str | None, container_id: str | None):
+        """
+        Adds this log entry to the database session for the specified agent and container.
+        :param session: Database session
+        :param agent_id: The ID of the agent uploading the log, the container must belong to it
+        :param container_id: Container ID from the request, must match self.container_id if given
         :return:
         """
+        if container_id is not None and self.container_id != container_id:
+            raise ValueError("Container ID mismatch")
 
         # Generate a unique ID for the log entry if not already set
         if self.id is None:
-            self.id = str(uuid4())
+            self.id = new_log_id()
+
+        bulk_insert_logs(session, [self], agent_id=agent_id)
+
+
+class ContainerNotFoundError(ValueError):
+    """
+    Raised when logs are sent for a container that does not exist or belongs to another agent.
+    """
+
+    def __init__(self):
+        super().__init__("Container not found")
+
 
-        session.add(self)
+# Number of log entries written per executemany by bulk_insert_logs
+LOG_INSERT_BATCH_SIZE = 500
+
+_log_columns = ["id", "container_id", "timestamp", "level", "message"]
+# Executed with one row per log entry plus the uploading agent's "agent_id". The select only yields the entry if its
+# container belongs to the agent, so the ownership check and the insert are one statement without a race in between.
+_insert_owned_logs = insert(Log.__table__).from_select(
+    _log_columns,
+    select(*(bindparam(column) for column in _log_columns)).where(
+        exists().where(Container.id == bindparam("container_id"), Container.agent_id == bindparam("agent_id"))
+    ),
+)
+
+
+def bulk_insert_logs(session: SessionDep, logs: list[Log], agent_id: str | None = None):
+    """
+    Inserts log entries with a single executemany instead of flushing them as individual ORM objects.
+    The on_insert processor hooks still run for every entry, like they do for session.add.
+    :param session: Database session
+    :param logs: The log entries to insert, with their IDs assigned
+    :param agent_id: If given, only entries of this agent's containers are inserted, the caller has not checked them
+    :raises ContainerNotFoundError: If an entry's container does not exist or belongs to another agent, the caller
+        has to roll back the entries that were inserted
+    """
+    def write(batch: list[dict]):
+        if agent_id is None:
+            session.exec(insert(Log), params=batch)
+            return
+
+        for row in batch:
+            row["agent_id"] = agent_id
+        if session.exec(_insert_owned_logs, params=batch).rowcount < len(batch):
+            raise ContainerNotFoundError()
+
+    rows: list[dict] = []
+    for log in logs:
+        prepared = session.prepare_insert(log) if isinstance(session, ProcessorSession) else log
+        if isinstance(prepared, Log):
+            rows.append(prepared.model_dump())
+        else:
+            # A processor replaced the entry with another model, that one is added normally
+            session.add(prepared)
+
+        # Large uploads are written in chunks, so only one chunk of parameter rows is held at a time
+        if len(rows) >= LOG_INSERT_BATCH_SIZE:
+            write(rows)
+            rows = []
+
+    if rows:
+        write(rows)
 
 
 class MultilineLogTransfer(BaseModel):
@@ -94,29 +237,47 @@ class MultilineLogTransfer(BaseModel):
     This class is used by the api endpoint to receive multiline log entries in a single transfer.
     """
     container_id: str
-    logs: list[Log]
+    logs: list[LogEntry]
 
     def add_log_entries(self, session: SessionDep, agent_id: str | None, container_id: str | None):
         """
         Adds log entries to the database session for the specified agent and container.
         :param session: Database session
-        :param agent_id: Not used in this context, kept for protocol compatibility
-        :param container_id: Container ID to which the logs belong, must match self.container_id and will be validated
+        :param agent_id: The ID of the agent uploading the logs. If given, the insert checks that the container belongs
+            to it instead of looking the container up first
+        :param container_id: Container ID from the request, must match self.container_id if given
+        """
+
+        logs = self.prepare_log_entries(session, container_id, skip_existence_check=agent_id is not None)
+        bulk_insert_logs(session, logs, agent_id=agent_id)
+
+    def prepare_log_entries(self, session: SessionDep, container_id: str | None,
+                            skip_existence_check: bool = False) -> list[Log]:
+        """
+        Validates this transfer and assigns IDs to its log entries without adding them to the session.
+        :param session: Database session
+        :param container_id: Container ID from the request, must match self.container_id if given
+        :param skip_existence_check: Set if the caller already verified that the container exists
+        :return: The log entries, ready to be added to the session
         """
 
-        if self.container_id != container_id:
+        if container_id is not None and self.container_id != container_id:
             raise ValueError("Container ID mismatch")
 
         if not self.logs:
             raise ValueError("No logs to add")
 
+        # The entries are inserted into their own container_id, which is the one the ownership check applies to
+        if any(log_entry.container_id != self.container_id for log_entry in self.logs):
+            raise ValueError("Container ID mismatch")
+
         # Check if container exists
-        db_container = session.get(Container, self.container_id)
-        if not db_container:
-            raise ValueError("Container not found")
+        if not skip_existence_check and not session.get(Container, self.container_id):
+            raise ContainerNotFoundError()
 
-        for log_entry in self.logs:
-            log_entry.add_log_entries(session, agent_id, self.container_id)
+        # The entries are already validated, build the table models without validating them again
+        log_ids = new_log_ids(len(self.logs))
+        return [log_entry.to_log(next(log_ids)) for log_entry in self.logs]
 
 
 class MultiContainerLogTransfer(BaseModel):
@@ -140,5 +301,18 @@ class MultiContainerLogTransfer(BaseModel):
         if not self.container_logs:
             raise ValueError("No container logs to add")
 
+        # Check all containers in one query instead of one lookup per container, containers of other agents count as
+        # not found
+        container_ids = {container_log.container_id for container_log in self.container_logs}
+        known_ids = set(session.exec(
+            select(Container.id).where(Container.id.in_(container_ids), Container.agent_id == agent_id)
+        ).all())
+
+        # Collect the logs of all containers first, so they are inserted in one batch
+        logs: list[Log] = []
         for container_log in self.container_logs:
-            container_log.add_log_entries(session, agent_id, container_log.container_id)
+            if container_log.container_id not in known_ids:
+                raise ContainerNotFoundError()
+            logs.extend(container_log.prepare_log_entries(session, container_log.container_id, skip_existence_check=True))
+
+        bulk_insert_logs(session, logs)
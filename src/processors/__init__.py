@@ -1,26 +1,37 @@
 from importlib import util
 import os
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from inspect import isabstract
-from typing import Optional, Type, get_args
+from types import ModuleType
+from typing import Optional, Type, Iterator, Sequence, get_args
 
 from fastapi import APIRouter
-from pydantic import BaseModel, PrivateAttr
-from sqlmodel import Session
+from pydantic import BaseModel
+from sqlmodel import Session, select
+from sqlmodel.sql.expression import Select
 
-from src.database import engine
+from src.database import SessionLocal
 
 
 class Processor[X: BaseModel, Y: BaseModel | None](BaseModel, metaclass=ABCMeta):
     interval: int = 60
-    _router: Optional[APIRouter] = PrivateAttr(default=None)
-    _session: Optional[Session] = PrivateAttr(default=None)
 
-    @property
-    def session(self) -> Session:
-        if self._session is None:
-            self._session = Session(engine)
-        return self._session
+    @contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """
+        Provides a session for a single unit of work, committed on success and rolled back on error.
+        The connection goes back to the pool afterwards instead of staying pinned to the processor.
+        """
+        session = SessionLocal()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     # "Incremental" processor methods (called for each data item)
 
@@ -46,6 +57,29 @@ class Processor[X: BaseModel, Y: BaseModel | None](BaseModel, metaclass=ABCMeta)
     def on_interval_each(self, data: X) -> Optional[Y]:
         pass
 
+    def interval_query(self, model_type: Type[X]) -> Optional[Select]:
+        """
+        The query whose rows are passed to on_interval_bulk. Processors can return a query that joins or aggregates
+        what they need, or None if they do not process items on the interval.
+        :param model_type: The model the processor is registered for
+        :return: The query to run on every interval, or None to skip the per-item processing
+        """
+        return select(model_type)
+
+    def on_interval_bulk(self, data: Sequence[X]) -> list[Y]:
+        """
+        Called at regular intervals with the items of the processor's model. By default, every item is passed to
+        on_interval_each, processors can override this to handle the whole batch with a few queries instead.
+        :param data: The items to process
+        :return: The non-empty results of processing the items
+        """
+        results: list[Y] = []
+        for item in data:
+            processed_item = self.on_interval_each(item)
+            if processed_item:
+                results.append(processed_item)
+        return results
+
     # Lifecycle methods
 
     @abstractmethod
@@ -56,11 +90,6 @@ class Processor[X: BaseModel, Y: BaseModel | None](BaseModel, metaclass=ABCMeta)
     def on_startup(self):
         pass
 
-    def close(self):
-        if self._session:
-            self._session.close()
-            self._session = None
-
     def get_generic_types(self):
         cls = type(self)
 
@@ -69,9 +98,12 @@ class Processor[X: BaseModel, Y: BaseModel | None](BaseModel, metaclass=ABCMeta)
         return get_args(base)
 
 
-def load_processors(path) -> list[type[Processor]]:
-    processors: list[Type[Processor]] = []
+# Executed processor modules per (path, newest modification time of their files)
+_loaded_modules: dict[tuple[str, int], list[ModuleType]] = {}
+
 
+def load_modules(path) -> list[ModuleType]:
+    paths: list[str] = []
     for root, dirs, files in os.walk(path):
         for file in files:
             if not file.endswith(".py"):
@@ -79,24 +111,51 @@ def load_processors(path) -> list[type[Processor]]:
             if file == "__init__.py":
                 continue
 
-            full_path = os.path.join(root, file)
-            module_name = file[:-3]
-
-            spec = util.spec_from_file_location(module_name, full_path)
-            if spec and spec.loader:
-                module = util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-
-                for attr in dir(module):
-                    val = getattr(module, attr)
-                    if not isinstance(val, type):
-                        continue
-                    if not issubclass(val, Processor):
-                        continue
-                    if val is Processor:
-                        continue
-                    if isabstract(val):
-                        continue
-
-                    processors.append(val)
+            paths.append(os.path.join(root, file))
+
+    # Only execute the modules again if one of them changed since they were last loaded
+    key = (path, max((os.stat(full_path).st_mtime_ns for full_path in paths), default=0))
+    if key in _loaded_modules:
+        return _loaded_modules[key]
+
+    modules: list[ModuleType] = []
+
+    for full_path in paths:
+        module_name = os.path.basename(full_path)[:-3]
+
+        spec = util.spec_from_file_location(module_name, full_path)
+        if spec and spec.loader:
+            module = util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            modules.append(module)
+
+    _loaded_modules[key] = modules
+    return modules
+
+
+def load_processors(path) -> list[type[Processor]]:
+    processors: list[Type[Processor]] = []
+
+    for module in load_modules(path):
+        for val in vars(module).values():
+            if not isinstance(val, type):
+                continue
+            if not issubclass(val, Processor):
+                continue
+            if val is Processor:
+                continue
+            if isabstract(val):
+                continue
+
+            processors.append(val)
     return processors
+
+
+def load_routers(path) -> list[APIRouter]:
+    """
+    Returns the module level `router` of every processor module that defines one.
+    """
+    return [
+        module.router for module in load_modules(path)
+        if isinstance(getattr(module, "router", None), APIRouter)
+    ]
@@ -2,35 +2,64 @@ from enum import Enum
 import logging
 from types import NoneType
 from typing import Optional
-from time import time
+from time import time_ns
 
+from fastapi import APIRouter
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlmodel import select, SQLModel, Field
 
+from src.database import SessionDep
 from src.processors import Processor
 from src.models.agents import Agent, ContainerState, Heartbeat, Container
 
 logger = logging.getLogger(__name__)
 
+# An agent is missing if it sent no heartbeat in double its interval, with 5% leniency (nanoseconds per interval second)
+MISSING_AFTER_NS = 2 * 1_050_000_000
+
 class AliveState(Enum):
     active = "active"
     inactive = "inactive"
 
 class AliveAgent(SQLModel, table=True):
-    agent_id: str = Field(primary_key=True, foreign_key="agent.id")
+    agent_id: str = Field(primary_key=True, foreign_key="agent.id", ondelete="CASCADE")
     state: AliveState
 
+# The statements of the interval check are built once, only their parameters change between ticks
+
+# Only the columns needed for the check, the newest heartbeat is kept on the agent itself
+_agent_heartbeats = select(Agent.id, Agent.heartbeat_interval, Agent.last_heartbeat_ns)
+
+# Rows whose state is unchanged are left alone so that steady-state ticks do not write anything
+_upsert_alive_agent = sqlite_insert(AliveAgent)
+_upsert_alive_agent = _upsert_alive_agent.on_conflict_do_update(
+    index_elements=[AliveAgent.agent_id],
+    set_={"state": _upsert_alive_agent.excluded.state},
+    where=AliveAgent.state != _upsert_alive_agent.excluded.state,
+)
+
+_mark_containers_unknown = update(ContainerState).where(
+    ContainerState.id.in_(
+        select(Container.id).where(Container.agent_id.in_(bindparam("agent_ids", expanding=True)))
+    ),
+    ContainerState.status != "unknown",
+).values(status="unknown").execution_options(synchronize_session=False)
+
+router = APIRouter()
+
+@router.get("/api/processors/active")
+def get_active_agents(session: SessionDep) -> dict[str, bool]:
+    # Only the two needed columns, no full AliveAgent objects
+    states = session.exec(
+        select(AliveAgent.agent_id, AliveAgent.state)
+    ).all()
+    return {agent_id: state == AliveState.active for agent_id, state in states}
+
 class HeartbeatProcessor(Processor[Heartbeat, NoneType]):
     interval: int = 5
 
     def on_startup(self):
-
-        @self._router.get("/api/processors/active")
-        def get_active_agents() -> dict[str, bool]:
-            agents: list[AliveAgent] = list(self.session.exec(
-                select(AliveAgent)
-            ).all())
-            return {a.agent_id: a.state == AliveState.active for a in agents}
-
         pass
 
     def on_insert(self, data: Heartbeat) -> Optional[Heartbeat]:
@@ -46,54 +75,35 @@ class HeartbeatProcessor(Processor[Heartbeat, NoneType]):
         # For each agent, check if we have received a heartbeat recently (its heartbeat_interval + leniency)
         # If heartbeats are missing, set all containers to 'unknown' state
         logger.debug("Running heartbeat interval check.")
-        agents: list[Agent] = list(self.session.exec(
-            select(Agent)
-        ).all())
-
-        current_time = time()
-
-        for agent in agents:
-            iv = agent.heartbeat_interval * 2 # Consider missing if no heartbeat in double the interval
-            leniency = 1.05  # 5% leniency
-
-            time_threshold = current_time -(iv * leniency)
-            heartbeats = self.session.exec(
-                select(Heartbeat).where(
-                    (Heartbeat.agent_id == agent.id) &
-                    (Heartbeat.timestamp >= time_threshold * 10**9)
-                )
-            ).all()
-
-            active: AliveAgent | None = self.session.get(AliveAgent, agent.id)
-            if not active:
-                active = AliveAgent(agent_id=agent.id, state=AliveState.active if heartbeats else AliveState.inactive)
-                self.session.add(active)
-                self.session.commit()
-            else:
-                if heartbeats and active.state == AliveState.inactive:
-                    active.state = AliveState.active
-                    self.session.add(active)
-                    self.session.commit()
-                elif not heartbeats and active.state == AliveState.active:
-                    active.state = AliveState.inactive
-                    self.session.add(active)
-                    self.session.commit()
-
-            if not heartbeats:
-                logger.warning(f"Agent {agent.id} is missing heartbeats. Marking its containers as 'unknown'.")
-                containers = self.session.exec(
-                    select(Container).where(
-                        Container.agent_id == agent.id
-                    )
-                ).all()
-
-                for container in containers:
-                    state = self.session.get(ContainerState, container.id)
-                    if state:
-                        state.status = "unknown"
-                        self.session.add(state)
-
-                self.session.commit()
+        with self.session_scope() as session:
+            agents = session.exec(_agent_heartbeats).all()
+
+            if not agents:
+                return
+
+            now_ns = time_ns()
+
+            alive: dict[str, bool] = {}
+            for agent_id, heartbeat_interval, latest_ns in agents:
+                threshold_ns = now_ns - heartbeat_interval * MISSING_AFTER_NS
+                alive[agent_id] = (latest_ns or 0) >= threshold_ns
+
+            stale = [agent_id for agent_id, is_alive in alive.items() if not is_alive]
+            for agent_id in stale:
+                logger.warning(f"Agent {agent_id} is missing heartbeats. Marking its containers as 'unknown'.")
+
+            # Insert or update the alive state of every agent in one statement
+            session.exec(_upsert_alive_agent, params=[
+                {"agent_id": agent_id, "state": AliveState.active if is_alive else AliveState.inactive}
+                for agent_id, is_alive in alive.items()
+            ])
+
+            if stale:
+                session.exec(_mark_containers_unknown, params={"agent_ids": stale})
+
+    def interval_query(self, model_type: type[Heartbeat]) -> None:
+        # Everything happens in on_interval, there is nothing to process per item
+        return None
 
     def on_interval_each(self, heartbeat: Heartbeat) -> Optional[Heartbeat]:
         pass
@@ -1,19 +1,22 @@
 import logging
-from uuid import uuid4
 from types import NoneType
-from typing import Optional
+from typing import Optional, Sequence
 from time import time
 
-from sqlalchemy import desc
-from sqlmodel import select, Field, SQLModel, Session
+from fastapi import APIRouter
+from sqlalchemy import Integer, and_, bindparam, case, desc, func, insert, literal, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.engine import Row
+from sqlmodel import select, Field, SQLModel
+from sqlmodel.sql.expression import Select
 
 from src.processors import Processor
-from src.models.agents import Container, ContainerState
-from src.database import engine
+from src.models.agents import Container, ContainerState, new_id
+from src.database import SessionDep
 logger = logging.getLogger(__name__)
 
 class ContainerUptime(SQLModel, table=True):
-    container_id: str = Field(primary_key=True, foreign_key="container.id")
+    container_id: str = Field(primary_key=True, foreign_key="container.id", ondelete="CASCADE")
     uptime_seconds: int = Field(default=0)
     uptime_percentage: float = Field(default=0.0)
     first_recorded: int = Field(default_factory=lambda: 0)
@@ -21,40 +24,93 @@ class ContainerUptime(SQLModel, table=True):
 
 class UptimeSection(SQLModel, table=True):
     id: str = Field(default=None, primary_key=True)
-    container_id: str = Field(foreign_key="container.id", index=True)
+    container_id: str = Field(foreign_key="container.id", ondelete="CASCADE", index=True)
     start_time: int = Field(default_factory=lambda: int(time()))
     end_time: int | None = Field(default=None)
     state: str = Field(default=None)
 
+# The statements of the interval pass are built once, only their parameters change between ticks.
+# They are scoped to the containers handed to on_interval_bulk.
+_container_ids = bindparam("container_ids", expanding=True)
+
+# Start tracking containers that have no uptime record yet
+_seed_uptime = insert(ContainerUptime).from_select(
+    ["container_id", "uptime_seconds", "uptime_percentage", "first_recorded"],
+    select(Container.id, literal(0), literal(0.0), Container.created_at).where(
+        Container.id.in_(_container_ids),
+        Container.id.not_in(select(ContainerUptime.container_id)),
+    ),
+).execution_options(dml_strategy="raw")
+
+# Update all uptime records in one statement. We assume "running" status means it's up.
+_running_ids = select(ContainerState.id).where(func.lower(ContainerState.status) == "running")
+_total_time = bindparam("now", type_=Integer) - ContainerUptime.first_recorded
+_uptime_seconds = case(
+    (ContainerUptime.container_id.in_(_running_ids), ContainerUptime.uptime_seconds + bindparam("delta", type_=Integer)),
+    else_=ContainerUptime.uptime_seconds,
+)
+# Fix for potential overcounting
+_uptime_seconds = case(
+    (and_(_total_time > 0, _uptime_seconds > _total_time), _total_time),
+    else_=_uptime_seconds,
+)
+_uptime_percentage = case(
+    (_total_time > 0, func.round(func.min(_uptime_seconds * 100.0 / _total_time, 100.0), 4)),
+    else_=0.0,
+)
+_update_uptime = update(ContainerUptime).where(ContainerUptime.container_id.in_(_container_ids)).values(
+    uptime_seconds=_uptime_seconds,
+    uptime_percentage=_uptime_percentage,
+).execution_options(synchronize_session=False)
+
+# Rank sections per container so the latest one can be joined without a query per container
+_ranked_sections = select(
+    UptimeSection,
+    func.row_number().over(
+        partition_by=UptimeSection.container_id, order_by=desc(UptimeSection.start_time)
+    ).label("position"),
+).subquery()
+_last_section = aliased(UptimeSection, _ranked_sections)
+
+# Every container with its state and latest section in one query, this is the processor's interval query
+_section_states = (
+    select(Container.id, ContainerState.status, _last_section)
+    .outerjoin(ContainerState, ContainerState.id == Container.id)
+    .outerjoin(_last_section, (_last_section.container_id == Container.id) & (_ranked_sections.c.position == 1))
+)
+
+# Executed with one {"id", "end_time"} row per section, as a bulk update by primary key
+_close_sections = update(UptimeSection)
+
+router = APIRouter()
+
+@router.get("/api/processors/uptime", tags=["API"])
+def get_uptime(session: SessionDep) -> list[ContainerUptime]:
+    return session.exec(
+        select(ContainerUptime)
+    ).all()
+
+@router.get("/api/processors/uptime/sections", tags=["API"])
+def get_uptime_sections(session: SessionDep) -> list[UptimeSection]:
+    return session.exec(
+        select(UptimeSection).order_by(UptimeSection.start_time)
+    ).all()
+
+@router.get("/api/processors/uptime/sections/{container_id}", tags=["API"])
+def get_uptime_sections_by_container(container_id: str, session: SessionDep) -> list[UptimeSection]:
+    return session.exec(
+        select(UptimeSection).where(UptimeSection.container_id == container_id).order_by(UptimeSection.start_time)
+    ).all()
+
+# Declared after the /sections routes, otherwise it would match "sections" as a container ID
+@router.get("/api/processors/uptime/{container_id}", tags=["API"])
+def get_uptime_by_container(container_id: str, session: SessionDep) -> Optional[ContainerUptime]:
+    return session.get(ContainerUptime, container_id)
+
 class UptimeProcessor(Processor[Container, NoneType]):
     interval: int = 5  # Check every minute
 
     def on_startup(self):
-        @self._router.get("/api/processors/uptime", tags=["API"])
-        def get_uptime() -> list[ContainerUptime]:
-            with Session(engine) as session:
-                return list(session.exec(
-                    select(ContainerUptime)
-                ).all())
-
-        @self._router.get("/api/processors/uptime/{container_id}", tags=["API"])
-        def get_uptime_by_container(container_id: str) -> Optional[ContainerUptime]:
-            with Session(engine) as session:
-                return session.get(ContainerUptime, container_id)
-
-        @self._router.get("/api/processors/uptime/sections", tags=["API"])
-        def get_uptime_sections() -> list[UptimeSection]:
-            with Session(engine) as session:
-                return list(session.exec(
-                    select(UptimeSection).order_by(UptimeSection.start_time)
-                ).all())
-
-        @self._router.get("/api/processors/uptime/sections/{container_id}", tags=["API"])
-        def get_uptime_sections_by_container(container_id: str) -> list[UptimeSection]:
-            with Session(engine) as session:
-                return list(session.exec(
-                    select(UptimeSection).where(UptimeSection.container_id == container_id).order_by(UptimeSection.start_time)
-                ).all())
         pass
 
     def on_insert(self, data: Container) -> Optional[Container]:
@@ -69,57 +125,54 @@ class UptimeProcessor(Processor[Container, NoneType]):
     def on_interval(self):
         pass
 
+    def interval_query(self, model_type: type[Container]) -> Select:
+        return _section_states
+
+    def on_interval_bulk(self, states: Sequence[Row]) -> list[NoneType]:
+        if not states:
+            return []
+
+        container_ids = [container_id for container_id, _, _ in states]
+        # One clock reading for the whole pass, so the uptime and the sections agree on the time
+        now = time()
+        current_time = int(now)
+        last_run = getattr(self, "_last_run", None)
+        # On the first run no uptime is added, to avoid overcounting on restarts
+        delta = int(now - last_run) if last_run else 0
+
+        # The whole pass is committed in one transaction instead of one commit per container
+        with self.session_scope() as session:
+            session.exec(_seed_uptime, params={"container_ids": container_ids})
+            session.exec(_update_uptime, params={"container_ids": container_ids, "now": current_time, "delta": delta})
+
+            closed_sections: list[dict] = []
+            new_sections: list[UptimeSection] = []
+            for container_id, status, last_section in states:
+                status = status or "unknown"
+
+                # Check for state changes
+                if last_section and last_section.state == status:
+                    continue
+
+                # Close previous section
+                if last_section and last_section.end_time is None:
+                    closed_sections.append({"id": last_section.id, "end_time": current_time})
+
+                # Start new section
+                new_sections.append(UptimeSection(
+                    id=new_id(),
+                    container_id=container_id,
+                    start_time=current_time,
+                    state=status
+                ))
+
+            if closed_sections:
+                session.exec(_close_sections, params=closed_sections)
+            session.add_all(new_sections)
+
+        return []
+
     def on_interval_each(self, container: Container) -> Optional[NoneType]:
-        state = self.session.get(ContainerState, container.id)
-        uptime_record = self.session.get(ContainerUptime, container.id)
-
-        if not uptime_record:
-            uptime_record = ContainerUptime(container_id=container.id, uptime_seconds=0, uptime_percentage=0.0,
-                                            first_recorded=container.created_at)
-
-        # We assume "running" status means it's up.
-        current_time = int(time())
-        if state and state.status.lower() == "running":
-            last_run = getattr(self, "_last_run", None)
-            if last_run:
-                delta = time() - last_run
-                uptime_record.uptime_seconds += int(delta)
-            else:
-                # First run, do not add uptime to avoid overcounting on restarts
-                pass
-
-        # Calculate percentage uptime
-        total_time = current_time - uptime_record.first_recorded
-
-        # Fix for potential overcounting
-        if total_time > 0 and uptime_record.uptime_seconds > total_time:
-            uptime_record.uptime_seconds = total_time
-
-        uptime_record.uptime_percentage = round(min((uptime_record.uptime_seconds / total_time) * 100,100.0) if total_time > 0 else 0.0,4)
-
-        self.session.add(uptime_record)
-
-        # Check for state changes
-        last_section = self.session.exec(
-            select(UptimeSection).where(UptimeSection.container_id == container.id).order_by(desc(UptimeSection.start_time))
-        ).first()
-        current_time = int(time())
-        if not last_section or last_section.state != (state.status if state else "unknown"):
-            # Close previous section
-            if last_section and last_section.end_time is None:
-                last_section.end_time = current_time
-                self.session.merge(last_section)
-
-            # Start new section
-            new_section = UptimeSection(
-                id=uuid4().hex,
-                container_id=container.id,
-                start_time=current_time,
-                state=state.status if state else "unknown"
-            )
-            self.session.add(new_section)
-
-        self.session.commit()
         return None
 
     def on_shutdown(self):
@@ -1,52 +1,75 @@
+import logging
+from itertools import groupby
 from typing import Optional
 import re
-from sqlmodel import select, col, Session
-from sqlalchemy.orm import object_session
+
+from pydantic import PrivateAttr
+from sqlalchemy import bindparam, delete, func, literal_column, update
+from sqlmodel import select
+
 from src.processors import Processor
 from src.models.agents import Log
 
+logger = logging.getLogger(__name__)
+
+# Repeat counter appended to compressed messages, e.g. "Connection refused x3"
+_SUFFIX_RE = re.compile(r' x(\d+)$')
+
+# Insertion order of the logs, used to only look at the logs that arrived since the last pass
+_rowid = literal_column("log.rowid")
+
+# Where the first pass after a start begins, SQLite reads the largest rowid from the end of the table
+_last_rowid = select(func.max(_rowid)).select_from(Log)
+
+# The logs that arrived since the last pass, grouped by container in the order they were written
+_new_logs = select(_rowid, Log.id, Log.container_id, Log.message).where(
+    _rowid > bindparam("after")
+).order_by(Log.container_id, Log.timestamp, _rowid)
+
+# The newest already compressed log of each container, so runs can continue across passes
+_ranked_tails = select(
+    Log.id, Log.container_id, Log.message,
+    func.row_number().over(
+        partition_by=Log.container_id, order_by=(Log.timestamp.desc(), _rowid.desc())
+    ).label("position"),
+).where(
+    _rowid <= bindparam("after"),
+    Log.container_id.in_(bindparam("container_ids", expanding=True)),
+).subquery()
+_tails = select(_ranked_tails.c.id, _ranked_tails.c.container_id, _ranked_tails.c.message).where(
+    _ranked_tails.c.position == 1
+)
+
+# Executed with one {"id", "message"} row per log, as a bulk update by primary key
+_update_messages = update(Log)
+_delete_logs = delete(Log).where(
+    Log.id.in_(bindparam("log_ids", expanding=True))
+).execution_options(synchronize_session=False)
+
+
+def _split_count(message: str) -> tuple[str, int]:
+    """
+    Splits a message into its base and its repeat count.
+    :param message: The message, optionally ending in an " xN" counter
+    :return: The message without the counter and the number of times it occurred
+    """
+    # Most messages carry no counter, skip the regex for those
+    match = _SUFFIX_RE.search(message) if " x" in message else None
+    if match:
+        return message[:match.start()], int(match.group(1))
+    return message, 1
+
+
 class LogCompressorProcessor(Processor[Log, Log]):
+    interval: int = 600
+    # Highest rowid of the logs that were already compressed, None until the first pass
+    _watermark: int | None = PrivateAttr(default=None)
+
     def on_startup(self):
         pass
 
-    interval: int = 600
-
     def on_insert(self, log: Log) -> Optional[Log]:
-        # Get the session associated with the log object
-        session: Session = object_session(log)
-
-        if not session:
-            return None
-
-        # Query the last log for this container
-        statement = select(Log).where(Log.container_id == log.container_id).order_by(col(Log.timestamp).desc()).limit(1)
-        result = session.exec(statement).first()
-
-        if result:
-            last_log = result
-
-            # Check if messages match (ignoring xNum suffix on the last log)
-            match = re.search(r' x(\d+)$', last_log.message)
-            last_msg_base = last_log.message
-            count = 1
-
-            if match:
-                count = int(match.group(1))
-                last_msg_base = last_log.message[:match.start()]
-
-            if log.message == last_msg_base:
-                # It's a repeat!
-                new_count = count + 1
-                last_log.message = f"{last_msg_base} x{new_count}"
-                last_log.timestamp = log.timestamp # Update timestamp to latest
-
-                session.add(last_log)
-
-                # Remove the new log from the session so it's not inserted
-                session.delete(log)
-
-                return last_log
-
+        # Repeated messages are compressed in batches by on_interval, keeping the insert path free of extra queries
         return None
 
     def on_get(self, data: Log) -> Optional[Log]:
@@ -56,11 +79,60 @@ class LogCompressorProcessor(Processor[Log, Log]):
         return None
 
     def on_interval(self):
-        pass
+        # Collapse consecutive repeats of a message per container into the newest of them, suffixed with " xN"
+        with self.session_scope() as session:
+            if self._watermark is None:
+                # Start at the newest log instead of reading the whole table after every restart. The logs the previous
+                # process received after its last pass stay as they are. Not done in on_startup, which runs before the
+                # tables are created or rebuilt.
+                self._watermark = session.exec(_last_rowid).one() or 0
+                return
+
+            new_logs = session.exec(_new_logs, params={"after": self._watermark}).all()
+            if not new_logs:
+                return
+
+            container_ids = list({container_id for _, _, container_id, _ in new_logs})
+            tails = {
+                container_id: (log_id, message)
+                for log_id, container_id, message in session.exec(
+                    _tails, params={"after": self._watermark, "container_ids": container_ids}
+                ).all()
+            }
+
+            updates: list[dict] = []
+            deleted: list[str] = []
+            for container_id, container_logs in groupby(new_logs, key=lambda row: row[2]):
+                # New messages are compared verbatim, a raw message can end in " xN" as well. Only the tail from an
+                # earlier pass carries a counter.
+                logs = [(log_id, message, 1) for _, log_id, _, message in container_logs]
+                if container_id in tails:
+                    tail_id, tail_message = tails[container_id]
+                    logs.insert(0, (tail_id, *_split_count(tail_message)))
+
+                for base, run in groupby(logs, key=lambda entry: entry[1]):
+                    run = list(run)
+                    if len(run) < 2:
+                        continue
+
+                    # Keep the newest log of the run, it carries the latest timestamp
+                    updates.append({"id": run[-1][0], "message": f"{base} x{sum(e[2] for e in run)}"})
+                    deleted.extend(log_id for log_id, _, _ in run[:-1])
+
+            if updates:
+                session.exec(_update_messages, params=updates)
+                session.exec(_delete_logs, params={"log_ids": deleted})
+                logger.debug(f"Compressed {len(deleted) + len(updates)} logs into {len(updates)}.")
+
+        # Only advanced once the pass is committed, so failed passes are retried
+        self._watermark = max(rowid for rowid, _, _, _ in new_logs)
+
+    def interval_query(self, model_type: type[Log]) -> None:
+        # Everything happens in on_interval, there is nothing to process per item
+        return None
 
     def on_interval_each(self, data: Log) -> Optional[Log]:
         return None
 
     def on_shutdown(self):
         pass
-
@@ -1,16 +1,45 @@
 import asyncio
 import logging
+import os
 import time
-from typing import Type, List, get_args
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Type, List, Any, Callable, NamedTuple, get_args
 
-from fastapi import APIRouter
-from sqlmodel import Session, select
+from sqlmodel import Session
+from sqlmodel.sql.expression import Select
 
-from src.database import engine
-from src.processors import Processor, load_processors
+from src.database import POOL_SIZE, engine
+from src.processors import Processor, load_processors, load_routers
 
 logger = logging.getLogger(__name__)
 
+# Processor methods invoked by ProcessorSession for single model instances
+HOOK_NAMES = ("on_insert", "on_get", "on_delete")
+
+# Rows of an interval query handed to on_interval_bulk at once, only one batch is held in memory at a time
+INTERVAL_BATCH_SIZE = 500
+
+# Number of processor intervals that may run at the same time. An interval holds up to two connections (the
+# manager's session for the interval query and the processor's own), so together they can only use half of the pool.
+MAX_CONCURRENT_INTERVALS = max(1, min(8, (os.cpu_count() or 1) * 2, POOL_SIZE // 2))
+
+
+class ProcessorHook(NamedTuple):
+    method: Callable[[Any], Any]
+    output_type: Type | None
+
+
+@lru_cache(maxsize=None)
+def _get_pydantic_generic_args(cls: Type[Processor]) -> tuple:
+    # Iterate over bases to find the one that has Pydantic metadata, the answer is fixed per class
+    for base in cls.__bases__:
+        metadata = getattr(base, "__pydantic_generic_metadata__", None)
+        if metadata and "args" in metadata:
+            return metadata["args"]
+    return ()
+
+
 class ProcessorManager:
     _instance = None
 
@@ -19,16 +48,23 @@ class ProcessorManager:
             cls._instance = super().__new__(cls)
             cls._instance.processors = []
             cls._instance.processors_by_model = {}
+            cls._instance.hooks = {}
+            cls._instance.routers = []
             cls._instance.running = False
+            cls._instance.stop_event = None
+            cls._instance.executor = ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENT_INTERVALS, thread_name_prefix="processor"
+            )
+            cls._instance.interval_slots = None
         return cls._instance
 
-    def load_all(self, path: str, router: APIRouter):
+    def load_all(self, path: str):
         logger.info(f"Loading processors from {path}")
+        self.routers = load_routers(path)
         processor_classes = load_processors(path)
         for cls in processor_classes:
             try:
                 instance = cls()
-                instance._router = router
                 self.processors.append(instance)
 
                 # Inspect generic type X
@@ -45,35 +81,59 @@ class ProcessorManager:
             except Exception as e:
                 logger.error(f"Failed to load processor {cls}: {e}")
 
+        self.build_hooks()
+
+    def build_hooks(self):
+        """
+        Resolves the hook methods and output types of all loaded processors once, so ProcessorSession does not have
+        to look them up for every model instance.
+        """
+        self.hooks = {
+            (model_type, hook_name): tuple(
+                ProcessorHook(getattr(processor, hook_name), self.get_output_type(type(processor)))
+                for processor in processors
+            )
+            for model_type, processors in self.processors_by_model.items()
+            for hook_name in HOOK_NAMES
+        }
+
     def get_model_type(self, cls: Type[Processor]) -> Type | None:
-        return self._get_pydantic_generic_args(cls)[0] if self._get_pydantic_generic_args(cls) else None
+        generic_args = _get_pydantic_generic_args(cls)
+        return generic_args[0] if generic_args else None
 
     def get_output_type(self, cls: Type[Processor]) -> Type | None:
-        return self._get_pydantic_generic_args(cls)[1] if self._get_pydantic_generic_args(cls) else None
-
-    @staticmethod
-    def _get_pydantic_generic_args(cls):
-        # Iterate over bases to find the one that has Pydantic metadata
-        for base in cls.__bases__:
-            metadata = getattr(base, "__pydantic_generic_metadata__", None)
-            if metadata and "args" in metadata:
-                return metadata["args"]
-        return ()
+        generic_args = _get_pydantic_generic_args(cls)
+        return generic_args[1] if generic_args else None
 
     def get_processors(self, model_type: Type) -> List[Processor]:
         return self.processors_by_model.get(model_type, [])
 
+    def get_hooks(self, model_type: Type, hook_name: str) -> tuple[ProcessorHook, ...]:
+        return self.hooks.get((model_type, hook_name), ())
+
+    def get_interval_groups(self) -> list[list[Processor]]:
+        """
+        Groups the processors that share a model and an interval. A group ticks together, so processors reading the
+        same rows only query them once per tick.
+        """
+        groups: dict[tuple[Type | None, int], list[Processor]] = {}
+        for processor in self.processors:
+            groups.setdefault((self.get_model_type(type(processor)), processor.interval), []).append(processor)
+        return list(groups.values())
+
     async def start_interval_loop(self):
         self.running = True
+        self.stop_event = asyncio.Event()
+        # Intervals waiting for a free worker wait here, where they can still be cancelled, not in the executor queue
+        self.interval_slots = asyncio.Semaphore(MAX_CONCURRENT_INTERVALS)
 
         self.tasks = []
-        for processor in self.processors:
-            task = asyncio.create_task(self._run_processor_loop(processor))
+        for processors in self.get_interval_groups():
+            task = asyncio.create_task(self._run_processor_loop(processors))
             self.tasks.append(task)
 
         try:
-            while self.running:
-                await asyncio.sleep(1)
+            await self.stop_event.wait()
         except asyncio.CancelledError:
             logger.info("Interval loop cancelled")
         finally:
@@ -82,81 +142,147 @@ class ProcessorManager:
             if self.tasks:
                 await asyncio.gather(*self.tasks, return_exceptions=True)
 
-    async def _run_processor_loop(self, processor: Processor):
-        while self.running:
-            start_time = time.time()
+    async def _run_processor_loop(self, processors: list[Processor]):
+        interval = processors[0].interval
+        loop = asyncio.get_running_loop()
+        # Ticks are scheduled on the loop's monotonic clock, so wall clock adjustments do not shift them
+        next_deadline = loop.time()
+        while not self.stop_event.is_set():
             try:
-                # Run blocking operations in a separate thread
-                await asyncio.to_thread(self._execute_processor_interval, processor)
+                # Run blocking operations on the processor threads
+                async with self.interval_slots:
+                    await loop.run_in_executor(self.executor, self._execute_processor_interval, processors)
             except Exception as e:
-                logger.error(f"Error in processor loop for {type(processor).__name__}: {e}")
+                names = ", ".join(type(processor).__name__ for processor in processors)
+                logger.error(f"Error in processor loop for {names}: {e}")
 
-            elapsed = time.time() - start_time
-            sleep_time = max(0.1, processor.interval - elapsed)
+            # Keep a fixed rhythm instead of sleeping a full interval after each tick, but skip the ticks that a
+            # long run missed instead of running them back to back
+            next_deadline += interval
+            if loop.time() > next_deadline + interval:
+                next_deadline = loop.time() + interval
 
-            if sleep_time > 0:
-                try:
-                    await asyncio.sleep(sleep_time)
-                except asyncio.CancelledError:
-                    break
+            # Wait for the next tick, but return as soon as the loop is stopped
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=max(0.0, next_deadline - loop.time()))
+            except TimeoutError:
+                continue
+            except asyncio.CancelledError:
+                break
+
+    def _execute_processor_interval(self, processors: list[Processor]):
+        # Surfaces pool exhaustion: checked out connections piling up here means the intervals wait for connections
+        logger.debug(f"Connection pool before interval: {engine.pool.status()}")
+
+        input_type = self.get_model_type(type(processors[0]))
+
+        succeeded: list[Processor] = []
+        # Processors whose interval queries are identical read the same rows, keyed by the query's SQL
+        readers: dict[str, tuple[Select, list[Processor]]] = {}
+        for processor in processors:
+            try:
+                processor.on_interval()
+                statement = processor.interval_query(input_type) if input_type else None
+            except Exception as e:
+                self._log_interval_error(processor, e)
+                continue
+
+            succeeded.append(processor)
+            if statement is not None:
+                readers.setdefault(str(statement), (statement, []))[1].append(processor)
+
+        # Also run on_interval_bulk (which calls on_interval_each per item unless overridden)
+        failed: set[int] = set()
+        for statement, statement_readers in readers.values():
+            failed.update(self._dispatch_interval_rows(statement, statement_readers, input_type))
+
+        finished_at = time.time()
+        for processor in succeeded:
+            if id(processor) not in failed:
+                setattr(processor, "_last_run", finished_at)
+
+    def _dispatch_interval_rows(self, statement: Select, processors: list[Processor], input_type: Type) -> set[int]:
+        """
+        Streams the rows of an interval query into on_interval_bulk of every processor reading them and stores their
+        results in one commit.
+        :param statement: The interval query shared by the processors
+        :param processors: The processors reading the rows
+        :param input_type: The model the processors are registered for
+        :return: The ids of the processors that failed, their results are discarded
+        """
+        failed: set[int] = set()
+        results: dict[int, list] = {id(processor): [] for processor in processors}
 
-    def _execute_processor_interval(self, processor: Processor):
         try:
-            processor.on_interval()
-
-            # Also run on_interval_each
-            model_type = self.get_model_type(type(processor))
-            if model_type:
-                with Session(engine) as session:
-                    statement = select(model_type)
-                    results = session.exec(statement).all()
-                    for item in results:
-                        # Process each item
-
-                        # TODO: Maybe make this async later or batch process or parallelize
-                        # TODO: Maybe handlelike real this item gets transformed into this other item (or nothing), this
-                        # Would allow for like collector tables that gather data, and this data would all be consumed into
-                        # another table or something.
-
-                        processed_item = processor.on_interval_each(item)
-
-                        if not processed_item:
+            with Session(engine) as session:
+                # Stream the rows in batches instead of loading the whole table at once
+                statement = statement.execution_options(stream_results=True, yield_per=INTERVAL_BATCH_SIZE)
+
+                # TODO: Maybe handlelike real this item gets transformed into this other item (or nothing), this
+                # Would allow for like collector tables that gather data, and this data would all be consumed into
+                # another table or something.
+                for batch in session.exec(statement).partitions():
+                    for processor in processors:
+                        if id(processor) in failed:
                             continue
+                        try:
+                            processed_items = processor.on_interval_bulk(batch)
+                            self._validate_interval_output(processor, processed_items)
+                        except Exception as e:
+                            self._log_interval_error(processor, e)
+                            failed.add(id(processor))
+                            continue
+                        results[id(processor)].extend(processed_items)
+
+                for processor in processors:
+                    if id(processor) in failed:
+                        continue
+                    if input_type == self.get_output_type(type(processor)):
+                        # Same type, update the items directly
+                        for item in results[id(processor)]:
+                            session.merge(item)
+                    else:
+                        # Different types, add the new items
+                        session.add_all(results[id(processor)])
+                session.commit()
+        except Exception as e:
+            for processor in processors:
+                self._log_interval_error(processor, e)
+            return {id(processor) for processor in processors}
 
-                        output_type = self.get_output_type(type(processor))
-
-                        if not output_type:
-                            raise Exception(f"Processor {type(processor).__name__} returned a value from on_interval_each but has no output type.")
-
-                        if not isinstance(processed_item, output_type):
-                            raise Exception(f"Processor {type(processor).__name__} returned wrong type from on_interval_each: expected {output_type.__name__}, got {type(processed_item).__name__}")
-
-                        input_type = self.get_model_type(type(processor))
-
-                        if not input_type:
-                            raise Exception(f"Processor {type(processor).__name__} has no input type defined.")
+        return failed
 
-                        if input_type == output_type:
-                            # Same type, update the item directly
-                            session.merge(processed_item)
-                        else:
-                            # Different types, add the new item
-                            session.add(processed_item)
-                    session.commit()
+    def _validate_interval_output(self, processor: Processor, processed_items: list):
+        if not processed_items:
+            return
 
+        output_type = self.get_output_type(type(processor))
+        if not output_type:
+            raise Exception(f"Processor {type(processor).__name__} returned a value from on_interval_each but has no output type.")
 
+        for processed_item in processed_items:
+            if not isinstance(processed_item, output_type):
+                raise Exception(f"Processor {type(processor).__name__} returned wrong type from on_interval_each: expected {output_type.__name__}, got {type(processed_item).__name__}")
 
-            setattr(processor, "_last_run", time.time())
-        except Exception as e:
-            import traceback
-            logger.error(f"Error running interval for {type(processor).__name__}: {e}\n{traceback.format_exc()}")
+    @staticmethod
+    def _log_interval_error(processor: Processor, e: Exception):
+        import traceback
+        logger.error(f"Error running interval for {type(processor).__name__}: {e}\n{traceback.format_exc()}")
+
+    def stop(self):
+        """
+        Signals the interval loops to exit without waiting for their next tick. Must be called from the event loop.
+        """
+        self.running = False
+        if self.stop_event is not None:
+            self.stop_event.set()
 
     def shutdown(self):
         self.running = False
         for processor in self.processors:
             try:
                 processor.on_shutdown()
-                processor.close()
             except Exception as e:
                 logger.error(f"Error shutting down processor {type(processor).__name__}: {e}")
+        self.executor.shutdown(wait=True)
 
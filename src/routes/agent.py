@@ -1,28 +1,110 @@
 import time
 
-from fastapi import  Query, Response, HTTPException
+from fastapi import  Query, Request, Response, HTTPException
+from starlette.concurrency import run_in_threadpool
 from typing import List
 
-from sqlmodel import select
+from sqlalchemy import bindparam, exists, func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
 
-from src.database import SessionDep
-from src.models.agents import Agent, Container, ContainerState, Log, Heartbeat, Context, MultiContainerLogTransfer, \
-    LogProtocol, MultilineLogTransfer
+from src.cache import known_agents, web_responses
+from src.database import SessionDep, SessionLocal
+from src.heartbeats import HeartbeatBuffer
+from src.models.agents import Agent, AgentConfig, Container, ContainerState, Context, LogEntry, \
+    MultiContainerLogTransfer, LogProtocol, MultilineLogTransfer, ContainerNotFoundError, new_id
 from src.routes import router
 import logging
-from uuid import uuid4
 
 logger = logging.getLogger("clogs.agent")
 
+# Statements of the endpoints below, built once at import instead of on every request. Their values are passed as
+# parameters, so SQLAlchemy also reuses the compiled SQL.
+_select_agent_exists = select(exists().where(Agent.id == bindparam("agent_id")))
+
+# The select only yields a row if the container belongs to the agent
+_upsert_container_state = sqlite_insert(ContainerState).from_select(
+    ["id", "status", "since"],
+    select(Container.id, bindparam("status"), bindparam("since")).where(
+        Container.id == bindparam("container_id"), Container.agent_id == bindparam("agent_id")
+    ),
+)
+_upsert_container_state = _upsert_container_state.on_conflict_do_update(
+    index_elements=[ContainerState.id],
+    set_={"status": _upsert_container_state.excluded.status, "since": _upsert_container_state.excluded.since},
+).execution_options(dml_strategy="raw")
+
+_detach_containers = update(Container).where(
+    Container.context == bindparam("context_id")
+).values(context=None).execution_options(synchronize_session=False)
+
+_agent_version = select(Agent.id, Agent.updated_at).where(Agent.id == bindparam("agent_id"))
+_agent_contexts = select(Context).where(Context.agent_id == bindparam("agent_id"))
+_agent_contexts_version = select(func.count(), func.max(Context.updated_at)).where(
+    Context.agent_id == bindparam("agent_id")
+)
+_agent_containers = select(Container).where(Container.agent_id == bindparam("agent_id"))
+_agent_containers_version = select(func.count(), func.max(Container.updated_at)).where(
+    Container.agent_id == bindparam("agent_id")
+)
+# Containers of one of the agent's contexts
+_context_containers = _agent_containers.where(Container.context == bindparam("context_id"))
+_context_containers_version = _agent_containers_version.where(Container.context == bindparam("context_id"))
+
+def agent_exists(session: Session, agent_id: str) -> bool:
+    """
+    Checks if an agent exists. Agents seen within the cache TTL are answered from memory, others with an EXISTS query
+    that does not load the row.
+    :param session: Database session, only used on a cache miss
+    :param agent_id: The ID of the agent
+    :return: True if the agent exists
+    """
+    if agent_id in known_agents:
+        return True
+
+    if not session.exec(_select_agent_exists, params={"agent_id": agent_id}).one():
+        return False
+
+    known_agents.add(agent_id)
+    return True
+
+def _agent_exists(agent_id: str) -> bool:
+    with SessionLocal() as session:
+        return agent_exists(session, agent_id)
+
+def version_etag(count: int, updated_at: int | None) -> str:
+    """
+    Builds a weak ETag from the number of rows and their newest write. Deletes change the count, inserts and updates
+    the newest write, so the ETag changes whenever the rows do.
+    :param count: The number of rows in the response
+    :param updated_at: The newest updated_at (ns) of the rows
+    :return: The ETag header value
+    """
+    return f'W/"{count}-{updated_at or 0}"'
+
+def not_modified(request: Request, response: Response, etag: str) -> bool:
+    """
+    Sets the ETag of the response and checks if the client already has this version.
+    :return: True if the request's If-None-Match matches the ETag, the endpoint can then answer with 304
+    """
+    response.headers["ETag"] = etag
+    return etag in request.headers.get("if-none-match", "")
+
 @router.post("/api/agent/")
-def register_new_agent(agent: Agent, session: SessionDep) -> str:
+def register_new_agent(config: AgentConfig, session: SessionDep) -> str:
+    # Only the configuration is taken from the body, the heartbeat and updated_at columns are maintained by the server
+    agent = Agent.model_validate(config)
     if not agent.id:
-        agent.id = str(uuid4())
+        agent.id = new_id()
+    agent_id = agent.id
 
+    # The id is assigned above, return it without loading the expired row back after the commit
     session.add(agent)
     session.commit()
-    session.refresh(agent)
-    return agent.id
+    web_responses.clear()
+    known_agents.add(agent_id)
+    return agent_id
 
 @router.delete("/api/agent/{agent_id}/", status_code=204)
 def delete_agent(agent_id: str, session: SessionDep):
@@ -32,102 +114,154 @@ def delete_agent(agent_id: str, session: SessionDep):
 
     session.delete(agent)
     session.commit()
+    web_responses.clear()
+
+    known_agents.discard(agent_id)
     return Response(status_code=204)
 
 @router.post("/api/agent/{agent_id}/heartbeat", status_code=204)
-def receive_agent_heartbeat(agent_id: str, session: SessionDep):
-    if not session.get(Agent, agent_id):
+async def receive_agent_heartbeat(agent_id: str):
+    # Runs on the event loop, known agents need no database access at all, unknown ones are looked up in a worker
+    # thread. The request session is not used, as its dependency would also take a worker thread per request.
+    if agent_id not in known_agents and not await run_in_threadpool(_agent_exists, agent_id):
         raise HTTPException(status_code=404, detail="Agent not found")
-    session.add(Heartbeat(agent_id=agent_id, timestamp=time.time_ns()))
-    session.commit()
+
+    # Written in bulk by the heartbeat buffer, this endpoint does not commit
+    HeartbeatBuffer().append(agent_id, time.time_ns())
     return
 
 @router.post("/api/agent/{agent_id}/container", status_code=201)
 def register_container(container: Container, session: SessionDep) -> str:
-    if not session.get(Agent, container.agent_id):
+    if not agent_exists(session, container.agent_id):
         raise HTTPException(status_code=404, detail="Agent not found")
 
     if not container.id:
-        container.id = str(uuid4())
-
-    if session.get(Container, container.id):
-        raise HTTPException(status_code=409, detail="Container with this ID already exists")
+        container.id = new_id()
+    container_id = container.id
+    # Set by the server, so an agent can not pin the ETag of the container list
+    container.updated_at = time.time_ns()
 
+    # The primary key rejects duplicates, so there is no need to look the container up first
     session.add(container)
-    session.commit()
-    session.refresh(container)
-    return container.id
-
-@router.post("/api/agent/{agent_id}/logs")
-def upload_agent_logs(agent_id: str, logs: MultiContainerLogTransfer | MultilineLogTransfer | Log, session: SessionDep):
-    if not session.get(Agent, agent_id):
-        raise HTTPException(status_code=404, detail="Agent not found")
-
-    if not isinstance(logs, LogProtocol) and not all(isinstance(logs, cls) for cls in (MultiContainerLogTransfer, MultilineLogTransfer, Log)):
-        raise HTTPException(status_code=400, detail="Invalid log format")
-
     try:
-        logs.add_log_entries(session, agent_id, None)
+        session.commit()
+        web_responses.clear()
+    except IntegrityError as e:
+        session.rollback()
+        if "FOREIGN KEY" in str(e.orig):
+            raise HTTPException(status_code=404, detail="Context not found")
+        raise HTTPException(status_code=409, detail="Container with this ID already exists")
+    return container_id
+
+def store_logs(session: Session, logs: LogProtocol, agent_id: str, container_id: str | None = None) -> Response:
+    """
+    Writes an upload of logs and commits it, or rolls it back and answers with the matching HTTP error.
+    :param session: Database session
+    :param logs: The upload, of any of the log transfer types
+    :param agent_id: The ID of the uploading agent, the containers must belong to it
+    :param container_id: The container of the request URL, None for uploads to the agent
+    """
+    try:
+        logs.add_log_entries(session, agent_id, container_id)
+        session.commit()
+    except ContainerNotFoundError as e:
+        session.rollback()
+        if container_id is None:
+            raise HTTPException(status_code=400, detail=str(e))
+        raise HTTPException(status_code=404, detail="Container not found or mismatched agent ID")
     except ValueError as e:
         session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    except IntegrityError:
+        # A container deleted while its logs were written
+        session.rollback()
+        raise HTTPException(status_code=400, detail="Container not found")
 
-    session.commit()
     return Response(status_code=200)
 
+# Each upload type has its own endpoint, so the body is validated against a single model
+
+@router.post("/api/agent/{agent_id}/logs/batch")
+def upload_agent_log_batch(agent_id: str, logs: MultiContainerLogTransfer, session: SessionDep):
+    if not agent_exists(session, agent_id):
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return store_logs(session, logs, agent_id)
+
+@router.post("/api/agent/{agent_id}/logs/multiline")
+def upload_agent_multiline_logs(agent_id: str, logs: MultilineLogTransfer, session: SessionDep):
+    if not agent_exists(session, agent_id):
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return store_logs(session, logs, agent_id)
+
+@router.post("/api/agent/{agent_id}/logs/single")
+def upload_agent_log(agent_id: str, logs: LogEntry, session: SessionDep):
+    if not agent_exists(session, agent_id):
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return store_logs(session, logs, agent_id)
+
+@router.post("/api/agent/{agent_id}/logs", deprecated=True)
+def upload_agent_logs(agent_id: str, logs: MultiContainerLogTransfer | MultilineLogTransfer | LogEntry, session: SessionDep):
+    """
+    Accepts any upload type, pydantic has to try the types one by one. Kept for agents that do not use the typed
+    endpoints yet.
+    """
+    if not agent_exists(session, agent_id):
+        raise HTTPException(status_code=404, detail="Agent not found")
+    return store_logs(session, logs, agent_id)
+
 
 @router.post("/api/agent/{agent_id}/container/{container_id}/")
 def update_container_state(agent_id: str, container_id: str, container: Container, session: SessionDep):
-    db_container = session.get(Container, container_id)
-    if not db_container or db_container.agent_id != agent_id:
+    # Update by primary key in one statement, the agent condition doubles as the ownership check
+    try:
+        result = session.exec(
+            update(Container)
+            .where(Container.id == container_id, Container.agent_id == agent_id)
+            # Skip primary key and owner, and the fields the agent did not send so only those columns are written.
+            # updated_at is left to onupdate, so an agent can not pin the ETag of the container list.
+            .values(**container.model_dump(exclude={"id", "agent_id", "updated_at"}, exclude_unset=True))
+            .execution_options(synchronize_session=False)
+        )
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=404, detail="Context not found")
+    if not result.rowcount:
         raise HTTPException(status_code=404, detail="Container not found or mismatched agent ID")
 
-    for field, value in container.model_dump().items():
-        if field.endswith("id"):
-            continue  # Skip primary key and foreign key fields
-        setattr(db_container, field, value)
-
     session.commit()
+    web_responses.clear()
     return Response(status_code=200)
 
 
-@router.post("/api/agent/{agent_id}/container/{container_id}/logs")
-def upload_container_logs(agent_id: str, container_id: str, logs: Log | MultilineLogTransfer, session: SessionDep):
-    if not isinstance(logs, LogProtocol) and not all(isinstance(logs, cls) for cls in (MultilineLogTransfer, Log)):
-        raise HTTPException(status_code=400, detail="Invalid log format")
+# The inserts only take the entries if the container belongs to the agent, there is no lookup up front
 
-    db_container = session.get(Container, container_id)
-    if not db_container or db_container.agent_id != agent_id:
-        raise HTTPException(status_code=404, detail="Container not found or mismatched agent ID")
+@router.post("/api/agent/{agent_id}/container/{container_id}/logs/multiline")
+def upload_container_multiline_logs(agent_id: str, container_id: str, logs: MultilineLogTransfer, session: SessionDep):
+    return store_logs(session, logs, agent_id, container_id)
 
-    try:
-        logs.add_log_entries(session, agent_id, container_id)
-    except ValueError as e:
-        session.rollback()
-        raise HTTPException(status_code=400, detail=str(e))
+@router.post("/api/agent/{agent_id}/container/{container_id}/logs/single")
+def upload_container_log(agent_id: str, container_id: str, logs: LogEntry, session: SessionDep):
+    return store_logs(session, logs, agent_id, container_id)
 
-    session.commit()
-    return Response(status_code=200)
+@router.post("/api/agent/{agent_id}/container/{container_id}/logs", deprecated=True)
+def upload_container_logs(agent_id: str, container_id: str, logs: MultilineLogTransfer | LogEntry, session: SessionDep):
+    """
+    Accepts either upload type, kept for agents that do not use the typed endpoints yet.
+    """
+    return store_logs(session, logs, agent_id, container_id)
 
 
 @router.post("/api/agent/{agent_id}/container/{container_id}/status")
 def update_container_status(agent_id: str, container_id: str, status: str, since: int, session: SessionDep):
-    container = session.get(Container, container_id)
-    if not container or container.agent_id != agent_id:
+    # Insert or update the state in one statement
+    result = session.exec(_upsert_container_state, params={
+        "container_id": container_id, "agent_id": agent_id, "status": status, "since": since,
+    })
+    if not result.rowcount:
         raise HTTPException(status_code=404, detail="Container not found or mismatched agent ID")
 
-    container_state = session.get(ContainerState, container_id)
-    if not container_state:
-        container_state = ContainerState(
-            id=container_id,
-            status=status,
-            since=since
-        )
-        session.merge(container_state)
-    else:
-        container_state.status = status
-
     session.commit()
+    web_responses.clear()
     return Response(status_code=200)
 
 @router.delete("/api/agent/{agent_id}/container/{container_id}/")
@@ -136,28 +270,34 @@ def delete_container(agent_id: str, container_id: str, session: SessionDep):
     if not container or container.agent_id != agent_id:
         raise HTTPException(status_code=404, detail="Container not found or mismatched agent ID")
 
+    # The database deletes its state, logs and other dependent rows along with it
     session.delete(container)
     session.commit()
-
-    # Also delete associated container state
-    container_state = session.get(ContainerState, container_id)
-    if not container_state:
-        raise HTTPException(status_code=404, detail="Inconsistent: Container state, for deletion, not found")
-
-    session.delete(container_state)
-    session.commit()
+    web_responses.clear()
 
     return Response(status_code=200)
 
 @router.put("/api/agent/{agent_id}/context/", status_code=201)
-def register_context(agent_id: str, context: Context, session: SessionDep):
-    if not session.get(Agent, agent_id):
+def register_context(agent_id: str, context: Context, session: SessionDep) -> int:
+    if not agent_exists(session, agent_id):
         raise HTTPException(status_code=404, detail="Agent not found")
 
+    # Contexts are registered by their agent, a different agent in the body would be rejected by the foreign key
+    context.agent_id = agent_id
+    # Set by the server, so an agent can not pin the ETag of the context list
+    context.updated_at = time.time_ns()
+
+    # The flush assigns the autoincrement id, read it before the commit expires the object so it is not reloaded
     session.add(context)
+    try:
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="Context with this ID already exists")
+    context_id = context.id
     session.commit()
-    session.refresh(context)
-    return context.id
+    web_responses.clear()
+    return context_id
 
 @router.delete("/api/agent/{agent_id}/context/{context_id}/", status_code=204)
 def delete_context(agent_id: str, context_id: int, session: SessionDep):
@@ -165,15 +305,29 @@ def delete_context(agent_id: str, context_id: int, session: SessionDep):
     if not context or context.agent_id != agent_id:
         raise HTTPException(status_code=404, detail="Context not found or mismatched agent ID")
 
+    # The foreign key would also clear the containers' context, but detaching them here bumps their updated_at, so
+    # the ETag of the container list changes as well
+    session.exec(_detach_containers, params={"context_id": context_id})
     session.delete(context)
     session.commit()
+    web_responses.clear()
     return Response(status_code=204)
 
 
 # GET endpoints for agent to retrieve its configuration
 
 @router.get("/api/agent/{agent_id}/")
-def get_agent_info(agent_id: str, session: SessionDep) -> Agent:
+def get_agent_info(agent_id: str, request: Request, response: Response, session: SessionDep) -> AgentConfig:
+    # Polled frequently, answer from the version of the row before loading and serializing it. The heartbeat columns
+    # are left out of the response, heartbeats do not change updated_at.
+    row = session.exec(_agent_version, params={"agent_id": agent_id}).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Agent not found")
+
+    etag = version_etag(1, row.updated_at)
+    if not_modified(request, response, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
     agent: Agent | None = session.get(Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agent not found")
@@ -181,21 +335,27 @@ def get_agent_info(agent_id: str, session: SessionDep) -> Agent:
 
 
 @router.get("/api/agent/{agent_id}/context/")
-def get_agent_contexts(agent_id: str, session: SessionDep) -> List[Context]:
-
-    contexts = session.exec(
-        select(Context).where(Context.agent_id == agent_id)
-    ).all()
+def get_agent_contexts(agent_id: str, request: Request, response: Response, session: SessionDep) -> List[Context]:
+    params = {"agent_id": agent_id}
+    count, version = session.exec(_agent_contexts_version, params=params).one()
+    etag = version_etag(count, version)
+    if not_modified(request, response, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    return list(contexts)
+    return session.exec(_agent_contexts, params=params).all()
 
 @router.get("/api/agent/{agent_id}/container/")
-def get_agent_containers(agent_id: str, session: SessionDep, context_id: int | None = Query(default=None)) -> List[Container]:
-    query = select(Container).where(Container.agent_id == agent_id)
+def get_agent_containers(agent_id: str, request: Request, response: Response, session: SessionDep,
+                         context_id: int | None = Query(default=None)) -> List[Container]:
+    params = {"agent_id": agent_id}
+    version_query, query = _agent_containers_version, _agent_containers
     if context_id is not None:
-        query = query.where(Container.context == context_id)
-
-    containers = session.exec(query).all()
+        params["context_id"] = context_id
+        version_query, query = _context_containers_version, _context_containers
 
-    return list(containers)
+    count, version = session.exec(version_query, params=params).one()
+    etag = version_etag(count, version)
+    if not_modified(request, response, etag):
+        return Response(status_code=304, headers={"ETag": etag})
 
+    return session.exec(query, params=params).all()
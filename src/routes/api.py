@@ -1,16 +1,60 @@
 import logging
-from typing import Union, List, Any
+from collections import defaultdict
+from functools import lru_cache
+from typing import Iterator, Union, List, Any
+
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy import bindparam
 from sqlmodel import select
 from sqlmodel import Session
+from sqlmodel.sql.expression import Select
 
-from src.database import SessionDep
+from src.cache import web_responses
+from src.database import SessionDep, SessionLocal
 from src.models.agents import Container, ContainerState, Context, Log, Agent
 from src.routes import router
 
 logger = logging.getLogger(__name__)
 
+# Statements of the endpoints below, built once at import instead of on every request
+# The states are joined in, only those of orphaned containers are read
+_orphans = select(Container, ContainerState).outerjoin(
+    ContainerState, Container.id == ContainerState.id
+).where(
+    Container.context.is_(None),
+)
+# Only the columns of the service entries are read, not whole rows of the three tables
+_service_columns = (
+    Container.id, Container.agent_id, Container.context, Container.name, Container.image, Container.created_at,
+    Container.updated_at, ContainerState.status, ContainerState.since, Context.type,
+)
+_service_fields = tuple(column.key for column in _service_columns)
+_services = select(Context.name, *_service_columns).join(
+    Context, Container.context == Context.id
+).join(
+    ContainerState, Container.id == ContainerState.id
+)
+_agents = select(Agent)
+
+
+@lru_cache(maxsize=None)
+def _logs_query(by_container: bool, by_level: bool) -> Select:
+    """
+    Builds the log query for one combination of filters, there are only four of them, so each is built once.
+    :param by_container: Filter by the "container_id" parameter
+    :param by_level: Filter by the "level" parameter
+    :return: The newest "limit" logs matching the filters
+    """
+    statement = select(Log)
+    if by_container:
+        statement = statement.where(Log.container_id == bindparam("container_id"))
+    if by_level:
+        statement = statement.where(Log.level == bindparam("level"))
+    return statement.order_by(Log.timestamp.desc()).limit(bindparam("limit"))
+
 @router.get("/api/health", tags=["API"])
-def health_check():
+async def health_check() -> dict[str, str]:
     """
     Health check endpoint to verify that the API is running.
     """
@@ -21,31 +65,17 @@ class _IntersectionContainerAndState(Container, ContainerState):
     pass
 
 @router.get("/api/web/orphans", tags=["API"])
+@web_responses.cached("orphans")
 def get_orphans(session: SessionDep) -> list[_IntersectionContainerAndState]:
     """
     Retrieves a list of containers that do not have an associated state entry.
     These are considered "orphaned" containers.
     :return:
     """
-
-    orphans = []
-    statement = select(Container).where(
-        Container.context.is_(None),
-    )
-    results = session.exec(statement).all()
-
-    statuses: dict[str, ContainerState] = {}
-    state_statement = select(ContainerState)
-    state_results = session.exec(state_statement).all()
-    for state in state_results:
-        statuses[state.id] = state
-
+    results = session.exec(_orphans).all()
 
     orphans: list[_IntersectionContainerAndState] = []
-    for container in results:
-        status = statuses.get(container.id, None)
-
-
+    for container, status in results:
         orphan = _IntersectionContainerAndState(
             id=container.id,
             agent_id=container.agent_id,
@@ -53,6 +83,7 @@ def get_orphans(session: SessionDep) -> list[_IntersectionContainerAndState]:
             name=container.name,
             image=container.image,
             created_at=container.created_at,
+            updated_at=container.updated_at,
             status=status.status if status else "unknown",
             since=status.since if status else 0,
         )
@@ -64,80 +95,63 @@ class _IntersectionContainerContainerAndState(_IntersectionContainerAndState, Co
     pass
 
 @router.get("/api/web/services", tags=["API"])
+@web_responses.cached("services")
 def get_services(session: SessionDep) -> dict[str, List[_IntersectionContainerContainerAndState]]:
     """
     Retrieves a mapping of context names to their associated containers and states.
     :return:
     """
-    statement = select(Container, Context, ContainerState).join(
-        Context, Container.context == Context.id
-    ).join(
-        ContainerState, Container.id == ContainerState.id
-    )
-
-    results = session.exec(statement).all()
-
-    services: dict[str, List[_IntersectionContainerContainerAndState]] = {}
-    for container, context, state in results:
-
-
-
-        service = _IntersectionContainerContainerAndState(
-            id=container.id,
-            agent_id=container.agent_id,
-            context=container.context,
-            name=container.name,
-            image=container.image,
-            created_at=container.created_at,
-            status=state.status,
-            since=state.since,
-            type=context.type,
+    services: defaultdict[str, List[_IntersectionContainerContainerAndState]] = defaultdict(list)
+    for context_name, *values in session.exec(_services):
+        # The values come from the database, build the entry without validating them again
+        services[context_name].append(
+            _IntersectionContainerContainerAndState.model_construct(**dict(zip(_service_fields, values)))
         )
-        if context.name not in services:
-            services[context.name] = []
-        services[context.name].append(service)
 
     return services
 
-@router.get("/api/web/logs", tags=["API"])
-def get_logs(container_id: Union[str, None] = None, limit: int = 100, level: str | None = None, session: SessionDep = SessionDep()) -> list[Log]:
+# Log rows fetched and serialized at a time while streaming
+LOG_STREAM_BATCH_SIZE = 500
+_log_list = TypeAdapter(list[Log])
+
+
+def _stream_logs(statement: Select, params: dict) -> Iterator[bytes]:
+    """
+    Writes the rows of a log query as a JSON array, one batch at a time.
+    The response outlives the request's dependencies, so the stream uses its own session.
+    """
+    with SessionLocal() as session:
+        yield b"["
+        separator = b""
+        for batch in session.exec(
+            statement.execution_options(yield_per=LOG_STREAM_BATCH_SIZE), params=params
+        ).partitions():
+            # Strip the brackets of the batch's array, the batches are joined into one array
+            yield separator + _log_list.dump_json(batch)[1:-1]
+            separator = b","
+        yield b"]"
+
+
+@router.get("/api/web/logs", tags=["API"], response_model=list[Log])
+def get_logs(container_id: Union[str, None] = None, limit: int = 100, level: str | None = None) -> StreamingResponse:
     """
     Retrieves logs for a specific container or all containers if no container_id is provided.
     :param level: The log level to filter by (e.g., "INFO", "ERROR"). If None, retrieves logs of all levels.
     :param container_id: The ID of the container to retrieve logs for. If None, retrieves logs for all containers.
     :param limit: The maximum number of log entries to retrieve.
-    :param session: The database session dependency.
-    :return: A list of log entries.
+    :return: A list of log entries, streamed while the rows are read.
     """
 
-    statement = select(Log)
-    if container_id:
-        statement = statement.where(Log.container_id == container_id)
-    if level:
-        statement = statement.where(Log.level == level.upper())
-    statement = statement.order_by(Log.timestamp.desc()).limit(limit)
+    statement = _logs_query(bool(container_id), bool(level))
+    params = {"container_id": container_id, "level": level.upper() if level else None, "limit": limit}
 
-    results = session.exec(statement).all()
-
-    return results
+    return StreamingResponse(_stream_logs(statement, params), media_type="application/json")
 
 @router.get("/api/web/agents", tags=["API"])
+@web_responses.cached("agents")
 def get_agents(session: SessionDep) -> list[Agent]:
     """
     Retrieves a list of agents with their details.
     :return:
     """
-    statement = select(Agent)
-    results = session.exec(statement).all()
-    agents: list[Agent] = []
-    for agent in results:
-        agent_model = Agent(
-            id=agent.id,
-            hostname=agent.hostname,
-            heartbeat_interval=agent.heartbeat_interval,
-            discovery_interval=agent.discovery_interval,
-            on_host=agent.on_host
-        )
-        agents.append(agent_model)
-
-    return agents
\ No newline at end of file
+    return session.exec(_agents).all()